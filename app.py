@@ -1,136 +1,523 @@
 import streamlit as st
 import openai
+import concurrent.futures
+import httpx
 import os
+import queue
+import re
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import threading
+import time
+from email.message import EmailMessage
+from email.policy import SMTP as SMTP_POLICY
 from audiorecorder import audiorecorder
+import base64
 import io
+import numpy as np
 # from datetime import date # dateを扱うためにインポート
 from datetime import date, datetime, timezone, timedelta
-import hashlib # importの追加
+from types import SimpleNamespace
+import xxhash # importの追加
 
 # --- 1. 初期設定 & 環境変数読み込み ---
 
 # Streamlit Community CloudのSecrets、またはローカルの.envファイルから読み込む
 # デプロイ時にはst.secretsを使用
-try:
-    openai.api_key = st.secrets["OPENAI_API_KEY"]
-    PASS_KEY = st.secrets["PASS_KEY"]
-    BREVO_SERVER = st.secrets["BREVO_SERVER"]
-    BREVO_PORT = int(st.secrets["BREVO_PORT"])
-    BREVO_USER = st.secrets["BREVO_USER"]
-    BREVO_PASSWORD = st.secrets["BREVO_PASSWORD"]
-    BREVO_SENDER = st.secrets["BREVO_SENDER"] # 送信元アドレスを登録＆指定が必要
-except (KeyError, FileNotFoundError):
-    # ローカル開発用のフォールバック
-    from dotenv import load_dotenv
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    PASS_KEY = os.getenv("PASS_KEY")
-    BREVO_SERVER = os.getenv("BREVO_SERVER")
-    BREVO_PORT = int(os.getenv("BREVO_PORT"))
-    BREVO_USER = os.getenv("BREVO_USER")
-    BREVO_PASSWORD = os.getenv("BREVO_PASSWORD")
-    BREVO_SENDER = os.getenv("BREVO_SENDER") # 送信元アドレスを登録＆指定が必要
-
-# セッションステートの初期化
-if "password_correct" not in st.session_state:
-    st.session_state.password_correct = False
-if "transcribed_text" not in st.session_state:
-    st.session_state.transcribed_text = ""
-if "summary_text" not in st.session_state:
-    st.session_state.summary_text = ""
+# rerunのたびにSecretsを読み直さないよう、キャッシュしてプロセス内で使い回す
+@st.cache_resource
+def load_config():
+    """Secrets／環境変数を一度だけ読み込み、設定オブジェクトとして返す"""
+    try:
+        source = st.secrets
+        source["OPENAI_API_KEY"]  # Secretsが無い環境ではここで例外になる
+    except (KeyError, FileNotFoundError):
+        # ローカル開発用のフォールバック
+        from dotenv import load_dotenv
+        load_dotenv()
+        source = os.environ
+    config = SimpleNamespace(
+        openai_api_key=source["OPENAI_API_KEY"],
+        pass_key=source["PASS_KEY"],
+        brevo_server=source["BREVO_SERVER"],
+        brevo_port=int(source["BREVO_PORT"]),
+        brevo_user=source["BREVO_USER"],
+        brevo_password=source["BREVO_PASSWORD"],
+        brevo_sender=source["BREVO_SENDER"], # 送信元アドレスを登録＆指定が必要
+        # 文字起こしバックエンド:
+        #   "openai"（Whisper API）/ "local"（faster-whisper）/ "gpu"（distil-whisper）
+        asr_backend=source.get("ASR_BACKEND", "openai"),
+        # 録音しながら逐次文字起こしするライブモード（要 streamlit-webrtc ＋ ローカルASR）
+        live_transcription=str(source.get("LIVE_TRANSCRIPTION", "")).lower() == "true",
+        # 要約モード: "two_step"（Whisper→GPT）または "fused"（gpt-4o-audioに直接音声を渡す）
+        summary_mode=source.get("SUMMARY_MODE", "two_step"),
+        # 要約バックエンド: "openai"（gpt-4.1-nano）または "local"（llama.cppのGGUFモデル）
+        summary_backend=source.get("SUMMARY_BACKEND", "openai"),
+        llm_model_path=source.get("LLM_MODEL_PATH", "Meta-Llama-3.1-8B-Instruct.Q4_K_M.gguf"),
+    )
+    return config
+
+# OpenAIクライアントも一度だけ生成し、TCP+TLS接続をkeep-aliveで使い回す
+# （毎回ハンドシェイクをやり直すと1リクエストあたり100〜300ms余分にかかる）
+@st.cache_resource
+def get_openai_client():
+    """keep-aliveプール付きのOpenAIクライアントを返す"""
+    config = load_config()
+    return openai.OpenAI(
+        api_key=config.openai_api_key,
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=4),
+        ),
+    )
 
 # --- 2. 機能関数 ---
 
 # --- st.session_stateの初期化 ---
 # アプリの初回起動時やリロード時に、必要なキーを初期化しておく
 def initialize_session_state():
-    if "transcribed_text" not in st.session_state:
-        st.session_state.transcribed_text = ""
-    if "summary_text" not in st.session_state:
-        st.session_state.summary_text = ""
-    if "last_audio_hash" not in st.session_state:      # ← 追加
-        st.session_state.last_audio_hash = None        # ← 追加
+    # 番兵キーを1つだけ調べ、初回のみ全デフォルトを一括登録する
+    # （rerunごとにキーの数だけdictを引くのをやめる）
+    if "_init" in st.session_state:
+        return
+    st.session_state.update({
+        "transcribed_text": "",
+        "summary_text": "",
+        "last_audio_hash": None,
+        "last_live_text": None,
+        "pending_live_text": None,
+        "_init": True,
+    })
 
-# 3. 録音データのハッシュを取得するヘルパー
-def get_audio_hash(audio_segment):
-    """AudioSegment を WAV にエクスポートし、SHA‑256 ハッシュ文字列を返す"""
+# 3. 録音データをWAVバイト列へエクスポートするヘルパー
+def export_wav_bytes(audio_segment):
+    """AudioSegment を WAV 形式のバイト列に一度だけエクスポートする"""
     buf = io.BytesIO()
     audio_segment.export(buf, format="wav")
-    return hashlib.sha256(buf.getvalue()).hexdigest()
-    
+    return buf.getvalue()
+
+# ローカル/GPUバックエンド用のPCM変換ヘルパー
+def audiosegment_to_float32(audio_segment):
+    """AudioSegmentを16kHzモノラルのfloat32 PCM配列に変換する（WAV経由なし）
+
+    ローカル推論ではWAVにエンコードしてもすぐPCMへデコードし直すだけなので、
+    pydubのリサンプリングで直接16kHzモノラルにし、エンコード＋デコードの
+    往復とバッファコピーを省く。
+    """
+    mono16k = audio_segment.set_channels(1).set_frame_rate(16000)
+    samples = np.asarray(mono16k.get_array_of_samples())
+    # サンプル幅ぶんのフルスケールで割って [-1, 1) に正規化する
+    return samples.astype(np.float32) / float(1 << (8 * mono16k.sample_width - 1))
+
+# 無音・誤クリック録音をAPIに投げる前に弾くVADゲート
+def has_speech(audio_segment, min_duration_ms=1000, min_speech_frames=10):
+    """録音に音声が含まれていそうかをWebRTC VADで判定する
+
+    1秒未満のクリップや音声フレームが閾値未満のクリップを送信前に棄却し、
+    WhisperとGPTのネットワーク往復を丸ごと節約する。
+    """
+    if len(audio_segment) < min_duration_ms:
+        return False
+    try:
+        import webrtcvad
+    except ImportError:
+        # VADが入っていない環境では音量ベースの簡易判定にフォールバック
+        return audio_segment.dBFS > -45
+    vad = webrtcvad.Vad(2)
+    pcm = audio_segment.set_channels(1).set_frame_rate(16000).set_sample_width(2).raw_data
+    frame_bytes = 2 * 16000 * 30 // 1000  # 30msフレーム
+    speech_frames = 0
+    for offset in range(0, len(pcm) - frame_bytes + 1, frame_bytes):
+        if vad.is_speech(pcm[offset:offset + frame_bytes], 16000):
+            speech_frames += 1
+            if speech_frames >= min_speech_frames:
+                return True
+    return False
+
+# 録音データのハッシュを取得するヘルパー
+def get_audio_hash(audio_segment):
+    """生PCMデータの xxHash3 ハッシュ文字列を返す（WAVエクスポート不要）"""
+    # 「新しい録音かどうか」の判定なので暗号学的強度は不要。
+    # 長さも混ぜて、同一PCMで長さだけ違うケースを区別する
+    return xxhash.xxh3_64_hexdigest(
+        audio_segment.raw_data + len(audio_segment).to_bytes(8, "little")
+    )
+
+# ブロッキングする外部呼び出しをメインスレッドから逃がすためのワーカープール
+@st.cache_resource
+def get_executor():
+    """プロセス内で共有するThreadPoolExecutorを返す"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+def wait_future(future, poll_interval=0.2):
+    """Futureの完了をポーリングで待って結果を返す（例外はそのまま送出）"""
+    while not future.done():
+        time.sleep(poll_interval)
+    return future.result()
+
+# ローカル文字起こし用のモデル（ASR_BACKEND="local" のときだけロードされる）
+# CTranslate2のint8カーネルでCPUでも4〜10倍速く、アップロード時間もゼロになる
+@st.cache_resource
+def get_local_asr():
+    """faster-whisperのモデルを一度だけロードしてプロセス内で共有する"""
+    # オプション依存: ローカルバックエンドを使うときだけ faster-whisper が必要
+    from faster_whisper import WhisperModel
+    return WhisperModel("small", device="auto", compute_type="int8")
+
+# GPUデプロイ用のパイプライン（ASR_BACKEND="gpu" のときだけロードされる）
+# distil-large-v2 + fp16 + Flash-Attention-2 でsoftmaxのHBMトラフィックを削減
+@st.cache_resource
+def get_gpu_asr():
+    """distil-whisperのGPUパイプラインを一度だけ構築して共有する"""
+    # オプション依存: GPUバックエンドを使うときだけ torch / transformers が必要
+    import torch
+    from transformers import pipeline
+    return pipeline(
+        "automatic-speech-recognition",
+        model="distil-whisper/distil-large-v2",
+        torch_dtype=torch.float16,
+        device="cuda:0",
+        model_kwargs={"attn_implementation": "flash_attention_2"},
+    )
+
 # 修正箇所: transcribe_audio 関数
 def transcribe_audio(audio_segment):
-    """Whisper APIを使ってAudioSegmentオブジェクトを文字起こしする"""
-    try:
-        # AudioSegmentをWAV形式のバイトデータに変換してメモリ上に保持
-        wav_buffer = io.BytesIO()
-        audio_segment.export(wav_buffer, format="wav")
-        wav_buffer.seek(0)  # バッファのポインタを先頭に戻す
+    """AudioSegmentを文字起こしする（Whisper API／ローカルfaster-whisper／GPU）
 
-        # OpenAI APIに渡すためにファイル名を設定
-        wav_buffer.name = "record.wav"
-        
-        with st.spinner("Whisperが音声を文字起こし中です..."):
-            transcript = openai.audio.transcriptions.create(
-                model="whisper-1",
-                file=wav_buffer, # 修正：バイトデータが入ったバッファを渡す
-            )
-        return transcript.text
-    except Exception as e:
-        st.error(f"文字起こし中にエラーが発生しました: {e}")
-        return ""
+    ローカル/GPUバックエンドには生PCMのfloat32配列を直接渡し、
+    WAVエクスポートはAPIアップロードが必要なopenaiバックエンドに限る。
+    ワーカースレッドから呼ばれるため、UI表示は行わず失敗時は例外を送出する。
+    """
+    config = load_config()
+    if config.asr_backend == "gpu":
+        audio = audiosegment_to_float32(audio_segment)
+        result = get_gpu_asr()(
+            {"raw": audio, "sampling_rate": 16000},
+            chunk_length_s=30, batch_size=24,
+            return_timestamps=False,
+        )
+        return result["text"]
 
+    if config.asr_backend == "local":
+        audio = audiosegment_to_float32(audio_segment)
+        segments, _info = get_local_asr().transcribe(
+            audio, beam_size=1, vad_filter=True,
+        )
+        return "".join(segment.text for segment in segments)
 
-def summarize_text(text):
-    """gpt-4.1-nanoを使ってテキストを要約する"""
-    try:
-        with st.spinner("GPTがテキストを要約中です..."):
-            response = openai.chat.completions.create(
-                model="gpt-4.1-nano",
+    # APIにはファイルとして渡す必要があるので、ここだけWAVへエクスポートする
+    wav_buffer = io.BytesIO(export_wav_bytes(audio_segment))
+
+    # OpenAI APIに渡すためにファイル名を設定
+    wav_buffer.name = "record.wav"
+
+    transcript = get_openai_client().audio.transcriptions.create(
+        model="whisper-1",
+        file=wav_buffer, # 修正：バイトデータが入ったバッファを渡す
+    )
+    return transcript.text
+
+
+# ローカル要約用の量子化モデル（SUMMARY_BACKEND="local" のときだけロードされる）
+# int4量子化の8B級モデルなら短い文字起こしはCPUでも1秒未満で要約でき、
+# ネットワーク往復そのものが消える
+@st.cache_resource
+def get_local_llm():
+    """llama.cppのGGUFモデルを一度だけロードしてプロセス内で共有する"""
+    # オプション依存: ローカル要約を使うときだけ llama-cpp-python が必要
+    from llama_cpp import Llama
+    config = load_config()
+    return Llama(
+        model_path=config.llm_model_path,
+        n_ctx=4096,
+        n_threads=os.cpu_count(),
+        n_gpu_layers=-1,
+    )
+
+# 同一テキストの再要約はキャッシュで返し、LLMの往復を丸ごと省く
+@st.cache_data(ttl=3600, show_spinner=False)
+def summarize_text(text, _placeholder=None):
+    """テキストを要約する（gpt-4.1-nanoのストリーミング受信／ローカルLLM）
+
+    _placeholder（st.empty）を渡すと、届いたトークンをその場に描画して
+    体感遅延を最初のトークンまでに縮める。先頭アンダースコア付きの引数は
+    st.cache_dataのキーに含まれないので、キャッシュは本文だけで効く。
+    結果は1時間キャッシュされ、同じ文字起こしの再要約ではモデルは呼ばれない。
+    失敗時は例外を送出する（例外はキャッシュされないので、呼び出し側で
+    表示すれば同じ文字起こしのリトライが可能なまま）。
+    """
+    config = load_config()
+    if config.summary_backend == "local":
+        with st.spinner("ローカルLLMがテキストを要約中です..."):
+            out = get_local_llm().create_chat_completion(
                 messages=[
                     {"role": "system", "content": "あなたはプロの編集者です。受け取ったテキストを簡潔で分かりやすい箇条書きの要約にしてください。"},
                     {"role": "user", "content": text}
                 ],
+                max_tokens=256,
             )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"要約中にエラーが発生しました: {e}")
-        return ""
+        return out["choices"][0]["message"]["content"]
+    with st.spinner("GPTがテキストを要約中です..."):
+        stream = get_openai_client().chat.completions.create(
+            model="gpt-4.1-nano",
+            messages=[
+                {"role": "system", "content": "あなたはプロの編集者です。受け取ったテキストを簡潔で分かりやすい箇条書きの要約にしてください。"},
+                {"role": "user", "content": text}
+            ],
+            stream=True,
+        )
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                # 全文を待たず、トークンが届くそばから描画する
+                if _placeholder is not None:
+                    _placeholder.markdown("".join(parts))
+    return "".join(parts)
+
+# 文字起こしと要約を1回のAPI往復に融合するパス（SUMMARY_MODE="fused"）
+# Whisper→GPTの2往復＋中間JSONのパースが、1往復・1フォワードパスになる
+def summarize_audio_fused(audio_segment):
+    """gpt-4o-audio-previewに音声を直接渡し、1回の往復で要約を得る
+
+    ワーカースレッドから呼ばれるため、UI表示は行わず失敗時は例外を送出する。
+    """
+    wav_bytes = export_wav_bytes(audio_segment)
+    response = get_openai_client().chat.completions.create(
+        model="gpt-4o-audio-preview",
+        modalities=["text"],
+        messages=[
+            {"role": "system", "content": "あなたはプロの編集者です。受け取った音声の内容を簡潔で分かりやすい箇条書きの要約にしてください。"},
+            {"role": "user", "content": [
+                {"type": "input_audio",
+                 "input_audio": {"data": base64.b64encode(wav_bytes).decode(),
+                                 "format": "wav"}},
+            ]},
+        ],
+    )
+    return response.choices[0].message.content
+
+def _connect_smtp(config):
+    """SMTP接続〜認証まで済ませたサーバーオブジェクトを返す
+
+    ポート465なら implicit TLS（SMTP_SSL）で接続し、EHLO→STARTTLS→再EHLOの
+    往復を省く。それ以外のポートでは従来どおりSTARTTLSで昇格する。
+    """
+    if config.brevo_port == 465:
+        server = smtplib.SMTP_SSL(config.brevo_server, config.brevo_port, timeout=30)
+    else:
+        server = smtplib.SMTP(config.brevo_server, config.brevo_port, timeout=30)
+        server.starttls()
+    server.login(config.brevo_user, config.brevo_password)
+    return server
+
+# 認証済みの接続をセッションをまたいで使い回し、送信ごとの
+# DNS+TCP+TLS+AUTHのハンドシェイクを初回だけにする
+@st.cache_resource
+def get_smtp_connection():
+    """認証済みSMTP接続をプロセス内で共有する"""
+    return _connect_smtp(load_config())
+
+# smtplib.SMTP はスレッドセーフではないので、共有接続へのコマンド書き込みは
+# このロックで直列化する（複数セッションが同時送信するとプロトコルが壊れる）
+@st.cache_resource
+def get_smtp_lock():
+    """共有SMTP接続用のロックをプロセス内で共有する"""
+    return threading.Lock()
+
+def _send_pipelined(server, from_address, to_address, message):
+    """PIPELINING拡張でMAIL FROM/RCPT TO/DATAを1回の書き込みにまとめて送る
+
+    サーバーが PIPELINING を広告していなければ従来の sendmail（1コマンド
+    1往復）にフォールバックする。Brevoでは3往復が1往復に縮む。
+    """
+    if "pipelining" not in server.esmtp_features:
+        server.sendmail(from_address, to_address, message)
+        return
+    if isinstance(message, str):
+        message = smtplib._fix_eols(message).encode("ascii")
+    # 3コマンドを一度に書き込み、応答もまとめて読む
+    server.send(
+        f"mail FROM:<{from_address}>\r\n"
+        f"rcpt TO:<{to_address}>\r\n"
+        f"data\r\n"
+    )
+    for expected in (250, 250, 354):
+        code, resp = server.getreply()
+        if code != expected:
+            raise smtplib.SMTPResponseException(code, resp)
+    # smtplib.SMTP.data と同じドットスタッフィング＋終端処理
+    payload = re.sub(br"(?m)^\.", b"..", message)
+    if not payload.endswith(smtplib.bCRLF):
+        payload += smtplib.bCRLF
+    server.send(payload + b"." + smtplib.bCRLF)
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPResponseException(code, resp)
+
+def prewarm_smtp():
+    """要約の生成中に、キャッシュ済みSMTP接続の確立を裏で先行させる"""
+    get_executor().submit(get_smtp_connection)
+
+def _deliver_email(config, to_address, subject, body, from_address):
+    """メッセージ構築とSMTP送信のブロッキング部分（ワーカースレッドで実行）"""
+    # 平文1パートだけなのでMIMEMultipartは不要。EmailMessageなら
+    # フラットなメッセージを1パスで構築・直列化できる
+    msg = EmailMessage(policy=SMTP_POLICY)
+    msg['From'] = from_address
+    msg['To'] = to_address
+    msg['Subject'] = subject
+    msg.set_content(body)
+    # SMTPポリシーでCRLF改行のバイト列として一度だけ直列化する
+    payload = msg.as_bytes()
+
+    # 共有接続上のSMTPダイアログはロックで直列化する（再接続の判断ごと囲い、
+    # 他セッションの送信途中の接続をclearで巻き込まないようにする）
+    with get_smtp_lock():
+        server = None
+        try:
+            server = get_smtp_connection()
+            _send_pipelined(server, config.brevo_sender, to_address, payload)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # 切断された古い接続は、ソケットを閉じてからキャッシュを捨てて
+            # 張り直す（clearだけではclose()されずfdがリークする）。
+            # 550等の応答エラーは恒久的なのでリトライせずそのまま送出する
+            if server is not None:
+                try:
+                    server.close()
+                except OSError:
+                    pass
+            get_smtp_connection.clear()
+            _send_pipelined(get_smtp_connection(), config.brevo_sender, to_address, payload)
 
 def send_email(to_address, subject, body, from_address):
-    """BrevoのSMTPサーバーを使ってEmailを送信する"""
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = from_address
-        msg['To'] = to_address
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+    """BrevoのSMTPサーバーを使ってEmailを送信する
 
+    認証済みのキャッシュ接続を使うため、2通目以降はハンドシェイクなしで
+    送信できる。送信本体はワーカープールで実行し、メインスレッドは
+    進行表示だけ行う。
+    """
+    config = load_config()
+    try:
         with st.spinner("Emailを送信中です..."):
-            server = smtplib.SMTP(BREVO_SERVER, BREVO_PORT)
-            server.starttls()
-            server.login(BREVO_USER, BREVO_PASSWORD)
-            text = msg.as_string()
-            # server.sendmail(from_address, to_address, text)
-            server.sendmail(BREVO_SENDER, to_address, text)
-            server.quit()
+            future = get_executor().submit(
+                _deliver_email, config, to_address, subject, body, from_address,
+            )
+            wait_future(future)
         st.success("Emailを正常に送信しました！")
     except Exception as e:
         st.error(f"Email送信中にエラーが発生しました: {e}")
 
 
+def summarize_and_send(trans_text, email_to, config, summary_box=None):
+    """文字起こし結果を要約し、宛先が入力されていればEmailを送信する
+
+    summary_box を渡すと、要約のトークンが届くそばからそこへ描画される。
+    """
+    # ③ 要約（失敗したら空文字）
+    if trans_text.strip():
+        # 要約のストリーミング受信中に、SMTPのハンドシェイクを裏で進めておく
+        if email_to:
+            prewarm_smtp()
+        try:
+            st.session_state.summary_text = summarize_text(trans_text, _placeholder=summary_box)
+        except Exception as e:
+            # 失敗はキャッシュされないので、次のrerunで同じ文字起こしを再試行できる
+            st.error(f"要約中にエラーが発生しました: {e}")
+            st.session_state.summary_text = ""
+    else:
+        st.warning("文字起こしが失敗しました。")
+        st.session_state.summary_text = ""
+
+    # ④ Email送信
+    if email_to and st.session_state.summary_text.strip():
+        subject = "【自動送信】音声メモの要約"
+        send_email(email_to, subject,
+                   st.session_state.summary_text, config.brevo_sender)
+    else:
+        st.warning("メールアドレスが未入力、または要約が空です。")
+
+
+# --- ライブ文字起こし（LIVE_TRANSCRIPTION="true" のときだけ使われる） ---
+# 録音停止を待たずに1秒ごとにローカルWhisperへ音声を流し込むので、
+# 体感遅延が「録音時間＋アップロード＋推論」から約1秒まで縮む
+def live_transcription_ui():
+    """録音しながら逐次文字起こしする（録音中は部分結果を表示）
+
+    whisper-streaming のローリングバッファ方式の簡易版。バッファが15秒を
+    超えるたびにそこまでを確定し、再推論のコストを一定に保つ。
+    停止後の全文は pending_live_text としてセッションに保存し、
+    要約・メール送信は次のrerunで行う。
+    """
+    # オプション依存: ライブモードを使うときだけ streamlit-webrtc が必要
+    from streamlit_webrtc import WebRtcMode, webrtc_streamer
+
+    st.write("STARTを押すと、録音しながらリアルタイムに文字起こしします。")
+    ctx = webrtc_streamer(
+        key="live_asr",
+        mode=WebRtcMode.SENDONLY,
+        audio_receiver_size=256,
+        media_stream_constraints={"audio": True, "video": False},
+    )
+    partial_box = st.empty()
+    if not ctx.state.playing:
+        return None
+
+    model = get_local_asr()
+    sample_rate = 16000
+    confirmed = ""  # 確定済みテキスト
+    current = ""    # ローリングバッファの推論結果（まだ変わりうる）
+    buffer = np.zeros(0, dtype=np.float32)
+    pending = 0     # 前回の推論から追加されたサンプル数
+    while ctx.state.playing:
+        try:
+            frames = ctx.audio_receiver.get_frames(timeout=1)
+        except queue.Empty:
+            continue
+        for frame in frames:
+            samples = frame.to_ndarray().reshape(-1, len(frame.layout.channels))
+            mono = samples.astype(np.float32).mean(axis=1) / 32768.0
+            # WebRTCは48kHzで届くので、3サンプル平均で16kHzへ間引く
+            step = frame.sample_rate // sample_rate
+            if step > 1:
+                mono = mono[: len(mono) // step * step].reshape(-1, step).mean(axis=1)
+            buffer = np.concatenate([buffer, mono])
+            pending += len(mono)
+
+        # 1秒たまるごとにローリングバッファを再推論して部分結果を更新する
+        if pending >= sample_rate:
+            pending = 0
+            segments, _info = model.transcribe(buffer, beam_size=1, vad_filter=True)
+            current = "".join(segment.text for segment in segments)
+            partial_box.markdown(confirmed + current)
+
+            # 15秒を超えたらそこまでを確定してバッファを切り詰める。
+            # currentを全バッファで再計算した直後だけ行うこと——それ以外の
+            # タイミングで捨てると、前回の推論以降に届いた音声が失われる
+            if len(buffer) > 15 * sample_rate:
+                confirmed += current
+                current = ""
+                buffer = np.zeros(0, dtype=np.float32)
+
+    # 停止後: バッファの残りを確定し、全文はセッションに保存するだけにする。
+    # STOPクリックが新しいrerunを予約しているため、この実行は次の要素描画で
+    # 中断されうる——要約・メール送信はここでは行わず、次のrerunに任せる
+    if len(buffer):
+        segments, _info = model.transcribe(buffer, beam_size=1, vad_filter=True)
+        confirmed += "".join(segment.text for segment in segments)
+    st.session_state.pending_live_text = confirmed
+    return None
+
+
 # --- 3. 認証画面 ---
 
 def check_password():
     """パスワード入力画面を表示し、認証を行う"""
+    config = load_config()
     st.title("認証ページ")
     password = st.text_input("パスワードを入力してください", type="password")
 
     if st.button("ログイン"):
-        if password == PASS_KEY:
+        if password == config.pass_key:
             st.session_state.password_correct = True
             st.rerun()  # 画面を再描画してメインアプリを表示
         else:
@@ -138,21 +525,17 @@ def check_password():
 
 # --- 4. メインアプリケーション画面 ---
 
+# 利用期限（2025年10月10日）とJST。rerunごとに作り直さずモジュール定数にする
+JST = timezone(timedelta(hours=9), name='JST')
+EXPIRATION_DATE = date(2025, 10, 10)
+
 # 修正箇所: main_app 関数の中
 def main_app():
-    # 1. 利用期限を設定 (2025年10月10日)
-    expiration_date = date(2025, 10, 10)
-    
-    # 2. 今日の日付を取得
-    # today = date.today()
-    # 2. JSTを取得して、その値から、日付だけを抜き取る
-    JST = timezone(timedelta(hours=9), name='JST')
-    now_jst = datetime.now(JST)
-    today = now_jst.date()
-    
-    # 3. 今日の日付が利用期限を過ぎていないかチェック
-    if today > expiration_date:
-        st.error(f"このアプリケーションの利用期限（{expiration_date.strftime('%Y年%m月%d日')}）は終了しました。")
+    config = load_config()
+
+    # 今日（JST）の日付が利用期限を過ぎていないかチェック
+    if datetime.now(JST).date() > EXPIRATION_DATE:
+        st.error(f"このアプリケーションの利用期限（{EXPIRATION_DATE.strftime('%Y年%m月%d日')}）は終了しました。")
         st.info("ご利用ありがとうございました。")
         st.stop()  # ここでアプリの処理を完全に停止する
         
@@ -168,75 +551,126 @@ def main_app():
 
     # --- 音声録音 ---
     st.subheader("2. 音声を録音")
-    st.write("下のマイクアイコンをクリックして録音を開始・停止します。")
-    
-    # 修正：変数名をaudio_segmentに変更
-    audio_segment = audiorecorder(
-        start_prompt="⏹️ 録音開始", 
-        # stop_prompt="▶️ 録音停止",
-        stop_prompt="🔴 録音中... (クリックで停止)",
-        pause_prompt="",
-    #    icon_size="2x"
-    )
+
+    audio_segment = None
+    if config.live_transcription:
+        # ライブモード: 録音しながら逐次文字起こしする。停止後の全文は
+        # セッション経由で受け取り、STOPが予約したrerunの側で処理する
+        live_transcription_ui()
+    else:
+        st.write("下のマイクアイコンをクリックして録音を開始・停止します。")
+
+        # 修正：変数名をaudio_segmentに変更
+        audio_segment = audiorecorder(
+            start_prompt="⏹️ 録音開始",
+            # stop_prompt="▶️ 録音停止",
+            stop_prompt="🔴 録音中... (クリックで停止)",
+            pause_prompt="",
+        #    icon_size="2x"
+        )
+
+    # --- 結果表示の枠を先に作っておき、処理の進行に合わせてその場で埋める ---
+    # （st.rerun()でスクリプト全体を再実行するより、再実行1回ぶん速い）
+    st.subheader("3. 文字起こし結果")
+    trans_box = st.empty()
+    st.subheader("4. 要約結果")
+    summary_box = st.empty()
+    done_box = st.empty()
+
+    def _show_results():
+        """現在のセッション値で結果欄と完了メッセージを描画する"""
+        trans_box.text_area("結果", value=st.session_state.transcribed_text,
+                            height=200, key="transcribed_display")
+        summary_box.text_area("要約結果", value=st.session_state.summary_text,
+                              height=200, key="summary_display")
+        # VADで弾いた録音もハッシュは記録されるので、要約の有無も確認する
+        if st.session_state.last_audio_hash and st.session_state.summary_text:
+            done_box.success("録音 → 文字起こし → 要約 → Email送信が完了しました！")
 
     # ★★★ ここからが修正の核心部分 ★★★
-    if audio_segment is not None and len(audio_segment) > 0:
-        # 現在の音声データのバイト列表現を取得
+    if config.live_transcription:
+        live_text = st.session_state.get("pending_live_text")
+        if live_text is not None and live_text != st.session_state.last_live_text:
+            st.session_state.transcribed_text = live_text
+            st.session_state.summary_text = ""
+            summarize_and_send(live_text, email_to, config, summary_box)
+            # Email送信まで終えてから処理済み印を付ける——録音直後の
+            # 中断されうる実行で途中まで進んでも、次のrerunで再試行される
+            st.session_state.last_live_text = live_text
+            st.session_state.last_audio_hash = "live"  # 完了メッセージ表示用
+    elif audio_segment is not None and len(audio_segment) > 0:
+        # ハッシュは生PCMから直接計算（WAVエクスポートはWhisperアップロード時のみ）
         current_hash = get_audio_hash(audio_segment)
 
         # 前回とハッシュが違う＝新しい録音が検出されたときのみ実行
         if st.session_state.last_audio_hash != current_hash:
-            st.info("新しい音声を検出しました。文字起こし → 要約 → Email送信を開始します…")
-            
-            # ① **前回の結果をクリア**（ここで追加）
-            st.session_state.transcribed_text = ""
-            st.session_state.summary_text   = ""
-
-            # ② 文字起こし
-            trans_text = transcribe_audio(audio_segment)
-            st.session_state.transcribed_text = trans_text
-
-            # ③ 要約（失敗したら空文字）
-            if trans_text.strip():
-                summary = summarize_text(trans_text)
-                st.session_state.summary_text = summary
+            # 無音や誤クリックの短い録音はAPIを呼ばずにここで弾く
+            if not has_speech(audio_segment):
+                st.warning("音声が検出できませんでした（短すぎるか無音です）。録音し直してください。")
+                # 同じクリップを再判定しないようハッシュだけ更新する
+                st.session_state.last_audio_hash = current_hash
             else:
-                st.warning("文字起こしが失敗しました。")
-                st.session_state.summary_text = ""
-
-            # ④ Email送信
-            if email_to and st.session_state.summary_text.strip():
-                subject = "【自動送信】音声メモの要約"
-                send_email(email_to, subject,
-                           st.session_state.summary_text, BREVO_SENDER)
-            else:
-                st.warning("メールアドレスが未入力、または要約が空です。")
+                st.info("新しい音声を検出しました。文字起こし → 要約 → Email送信を開始します…")
 
-            # ハッシュを更新
-            st.session_state.last_audio_hash = current_hash
+                # ① **前回の結果をクリア**（ここで追加）
+                st.session_state.transcribed_text = ""
+                st.session_state.summary_text   = ""
 
-            # UI を即座にリフレッシュ
-            st.rerun()
-    else:
-        # 録音が終了していない／何も録音されていない場合はフラグをリセット
-        st.session_state.processing_done = False
+                if config.summary_mode == "fused":
+                    # ②＋③ 文字起こしと要約を1回の音声入力コールに融合
+                    if email_to:
+                        prewarm_smtp()
+                    with st.status("GPTが音声を直接要約中です...") as status:
+                        future = get_executor().submit(summarize_audio_fused, audio_segment)
+                        try:
+                            summary = wait_future(future)
+                            status.update(label="要約が完了しました", state="complete")
+                        except Exception as e:
+                            status.update(label=f"要約中にエラーが発生しました: {e}",
+                                          state="error")
+                            summary = ""
+                    st.session_state.transcribed_text = "（音声一括要約モードのため文字起こしは省略されます）"
+                    st.session_state.summary_text = summary
 
-    # --- 文字起こし結果表示 ---
-    st.subheader("3. 文字起こし結果")
-    st.text_area("結果", value=st.session_state.transcribed_text, height=200, key="transcribed_display")
+                    # ④ Email送信
+                    if email_to and summary.strip():
+                        send_email(email_to, "【自動送信】音声メモの要約",
+                                   summary, config.brevo_sender)
+                    else:
+                        st.warning("メールアドレスが未入力、または要約が空です。")
+                else:
+                    # SMTP接続の確立は最初のネットワーク呼び出しと並行して進める
+                    # （文字起こし＋要約の間ずっとオーバーラップできる）
+                    if email_to:
+                        prewarm_smtp()
 
-    # --- 要約・送信ボタンは削除したので、要約テキストとメール送信の表示だけに ---
-    st.subheader("4. 要約結果")
-    st.text_area("要約結果", value=st.session_state.summary_text, height=200, key="summary_display")
-    
-    # --- 5. Email送信（自動実行済みなら「完了」メッセージを表示） ---
-    if st.session_state.last_audio_hash:
-        st.success("録音 → 文字起こし → 要約 → Email送信が完了しました！")
+                    # ② 文字起こし（ブロッキング処理はワーカースレッドへ逃がし、
+                    #    st.statusで進行を見せながらFutureをポーリングで待つ）
+                    with st.status("Whisperが音声を文字起こし中です...") as status:
+                        future = get_executor().submit(transcribe_audio, audio_segment)
+                        try:
+                            trans_text = wait_future(future)
+                            status.update(label="文字起こしが完了しました", state="complete")
+                        except Exception as e:
+                            status.update(label=f"文字起こし中にエラーが発生しました: {e}",
+                                          state="error")
+                            trans_text = ""
+                    st.session_state.transcribed_text = trans_text
+
+                    # ③ 要約 → ④ Email送信
+                    summarize_and_send(trans_text, email_to, config, summary_box)
+
+                # ハッシュを更新（st.rerun()はせず、下でその場に結果を描画する）
+                st.session_state.last_audio_hash = current_hash
+
+    # --- 文字起こし・要約結果の表示（処理済みの値をその場に描画） ---
+    _show_results()
 
 # --- 5. アプリケーション実行 ---
 
 # 認証が済んでいるかチェック
-if st.session_state.password_correct:
+# （password_correct は認証成功時にのみ書き込まれるので、未設定はFalse扱い）
+if st.session_state.get("password_correct", False):
     main_app()
 else:
     check_password()
\ No newline at end of file